@@ -1,23 +1,32 @@
 #!/usr/bin/python3
 
-from collections import defaultdict
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
 import csv
-from datetime import datetime
+from datetime import date
+from functools import lru_cache, partial
+from itertools import islice
 import html as html_core
 import json
 import os
+import re
 import logging
 import logging.config
-import requests
 import shutil
-import yaml
-from rich.logging import RichHandler
-from rich.progress import track
-from rich.console import Console
+import threading
 
+# orjson is used for API responses and backups if it's installed, since it's several times faster than the json module
+try:
+  import orjson
+  json_loads = orjson.loads
+  def json_dumps(data):
+    return orjson.dumps(data, option=orjson.OPT_INDENT_2 | orjson.OPT_SORT_KEYS)
+except ImportError:
+  json_loads = json.loads
+  def json_dumps(data):
+    return json.dumps(data, sort_keys=True, indent=2, ensure_ascii=False).encode('utf8')
 
-import network_setup
-import send_notifications
+# requests, rich, yaml and send_notifications are slow to import, so they're imported where they're used
 
 # from rich.progress import (
 #     BarColumn,
@@ -31,7 +40,10 @@ import send_notifications
 
 ### Styling ###
 
-console = Console(record=False)
+@lru_cache(1)
+def get_console():
+  from rich.console import Console
+  return Console(record=False)
 
 # progress = Progress(
 #     TextColumn("[bold blue]{task.fields[filename]}", justify="right"),
@@ -44,6 +56,22 @@ console = Console(record=False)
 #     console=console
 # )
 
+### Caches ###
+
+# repositories and containers don't change during a run, so each one is only requested once.
+# Set no_cache: true in config.yml to look everything up fresh each time
+cache_enabled = True
+repository_cache = {}
+container_cache = {}
+top_container_cache = {}
+
+def set_cache(enabled=True):
+  global cache_enabled
+  cache_enabled = enabled
+  repository_cache.clear()
+  container_cache.clear()
+  top_container_cache.clear()
+
 ### Exceptions ###
 
 class FileNameError(Exception):
@@ -110,57 +138,106 @@ def set_api_url(drive_path, cfg):
     return cfg.get('api_url')
 
 def get_spreadsheet_list(drive_path):
-  files = os.listdir(drive_path)
-  return [f"{drive_path}/{filename}" for filename in files if filename.endswith('.csv')]
+  # scandir gets the file type along with the name, so there's no extra stat call per file on the network drive
+  with os.scandir(drive_path) as entries:
+    return [f"{drive_path}/{entry.name}" for entry in entries if entry.name.endswith('.csv') and entry.is_file()]
+
+def load_yaml(yaml_path):
+  # the parsed YAML is saved next to the original as JSON, which loads much faster. The JSON copy records the
+  # YAML file's mtime and size, and is only used while both still match exactly - so a file that's been replaced
+  # with an older copy (cp -p, rsync, git checkout) is parsed again too
+  yaml_stat = os.stat(yaml_path)
+  source = {'mtime_ns': yaml_stat.st_mtime_ns, 'size': yaml_stat.st_size}
+  sidecar_path = f"{yaml_path}.json"
+  try:
+    with open(sidecar_path, encoding='utf8') as sidecar:
+      cached = json.load(sidecar)
+    if cached.get('source') == source:
+      return cached['data']
+  except (OSError, ValueError, AttributeError, KeyError):
+    pass
+  import yaml
+  try:
+    from yaml import CSafeLoader as SafeLoader
+  except ImportError:
+    from yaml import SafeLoader
+  with open(yaml_path, encoding='utf8') as yaml_file:
+    data = yaml.load(yaml_file, Loader=SafeLoader)
+  temp_path = f"{sidecar_path}.{os.getpid()}.tmp"
+  try:
+    sidecar_text = json.dumps({'source': source, 'data': data})
+    if json.loads(sidecar_text)['data'] != data:
+      # JSON turns non-string keys like 1 or true into strings, so a file like that is always parsed from the YAML,
+      # since the cached copy would come back different
+      logging.debug(f'Not caching {yaml_path} as JSON, since it would not load back the same')
+      return data
+    # the copy gets the same permissions as the YAML file, since config.yml holds passwords. It's written to a
+    # temporary file first and renamed into place, so an older copy with looser permissions is replaced, not reused
+    mode = yaml_stat.st_mode & 0o777
+    with open(os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode), 'w', encoding='utf8') as sidecar:
+      os.fchmod(sidecar.fileno(), mode)
+      sidecar.write(sidecar_text)
+    os.replace(temp_path, sidecar_path)
+  except (OSError, TypeError):
+    # not being able to write the JSON copy just means the YAML gets parsed again next time
+    logging.debug(f'Could not cache {yaml_path} as JSON')
+    if os.path.exists(temp_path):
+      os.remove(temp_path)
+  return data
 
 def setup_logging(log_path, default_level=logging.DEBUG):
   if os.path.exists(log_path):
-    with open('logging_config.yml', 'r', encoding='utf8') as file_path:
-      cfg = yaml.safe_load(file_path.read())
-      cfg['handlers']['debug_file_handler']['filename'] = f'{log_path}/debug.log'
-      cfg['handlers']['error_file_handler']['filename'] = f'{log_path}/errors.log'
-      logging.config.dictConfig(cfg)
+    cfg = load_yaml('logging_config.yml')
+    cfg['handlers']['debug_file_handler']['filename'] = f'{log_path}/debug.log'
+    cfg['handlers']['error_file_handler']['filename'] = f'{log_path}/errors.log'
+    logging.config.dictConfig(cfg)
   else:
     logging.config.basicConfig(level=default_level)
 
 def get_config(config_file_path="config.yml"):
-  with open(config_file_path) as config_file:
-    config = yaml.safe_load(config_file.read())
-    return config
+  return load_yaml(config_file_path)
+
+# fieldnames for the input and output CSV files - built once, since they're the same for every file
+FIELDNAMES = ('Repository Name', 'Security Tag', 'Parent Record', 'Title', 'Component Unique ID', 'Type_1', 'Number_of_bytes', 'Container_Summary', 'Top Container', 'Collection Name', 'Event_Type_1', 'Outcome_1', 'Begin_1', 'Outcome_Note_1', 'Event_Type_2', 'Outcome_2', 'Begin_2', 'Outcome_Note_2', 'Event_Type_3', 'Outcome_3', 'Begin_3', 'Outcome_Note_3', 'This field will not be ingested into ArchivesSpace, this information is only shared with the Digital Accessioning Service')
+FIELDNAMES_EXTRAS = FIELDNAMES + ('New_Component_URI', 'Event_URI_1', 'Event_URI_2', 'Event_URI_3')
 
 def set_fieldnames(extras=False):
-  fieldnames = ['Repository Name', 'Security Tag', 'Parent Record', 'Title', 'Component Unique ID', 'Type_1', 'Number_of_bytes', 'Container_Summary', 'Top Container', 'Collection Name', 'Event_Type_1', 'Outcome_1', 'Begin_1', 'Outcome_Note_1', 'Event_Type_2', 'Outcome_2', 'Begin_2', 'Outcome_Note_2', 'Event_Type_3', 'Outcome_3', 'Begin_3', 'Outcome_Note_3', 'This field will not be ingested into ArchivesSpace, this information is only shared with the Digital Accessioning Service']
-  if extras:
-    fieldnames.extend(['New_Component_URI', 'Event_URI_1', 'Event_URI_2', 'Event_URI_3'])
-    return fieldnames
-  else:
-    return fieldnames
+  return list(FIELDNAMES_EXTRAS if extras else FIELDNAMES)
 
 def get_row_data(input_file, header_row_count=2):
   with open(input_file, encoding='utf8') as infile:
     csvfile = csv.reader(infile)
-    # skips the header_row(s) - can set the number of rows to skip
-    for i in range(header_row_count):
-      next(csvfile)
-    csvlist = list(csvfile)
-    # returns the row count and the first row
-    return len(csvlist), csvlist[0]
+    # skips the header_row(s) and reads the first row - can set the number of rows to skip
+    first_row = next(islice(csvfile, header_row_count, None))
+    # returns the row count and the first row. The rest of the rows are counted as they're read, rather than held in memory
+    return sum(1 for row in csvfile) + 1, first_row
+
+def get_container_parents(input_file, header_row_count=2):
+  # returns the unique parent record identifiers for all rows that have a top container, so their containers can be fetched up front
+  with open(input_file, encoding='utf8') as infile:
+    csvfile = islice(csv.reader(infile), header_row_count, None)
+    return list(dict.fromkeys(parse_parent_record(row[2])[1] for row in csvfile if len(row) > 8 and row[8]))
+
+# the resource and archival object identifiers are matched separately, so that any form of Parent Record URL works, i.e.
+# .../resources/1234#tree::archival_object_56789, .../resources/1234/#tree::archival_object_56789 or
+# .../resources/1234/edit#tree::archival_object_56789
+RESOURCE_ID_PATTERN = re.compile(r'resources/(\d+)')
+RECORD_ID_PATTERN = re.compile(r'archival_object(?:_|s/)(\d+)') ### also takes a plain .../archival_objects/56789 URL
+
+@lru_cache(maxsize=4096)
+def parse_parent_record(parent_record):
+  # most rows in a spreadsheet share a parent, so each URL is only parsed once. Returns an empty string for any
+  # identifier that isn't in the URL
+  resource_match = RESOURCE_ID_PATTERN.search(parent_record)
+  record_match = RECORD_ID_PATTERN.search(parent_record)
+  return resource_match[1] if resource_match else '', record_match[1] if record_match else ''
 
 def set_parent(first_row):
-  # error handling - should be a digit between 0 and 9999999
-  return str(first_row[2]).rpartition("_")[2]
+  return parse_parent_record(str(first_row[2]))[1]
 
 def get_agent_id(first_row):
   return first_row[22]
 
-def set_resource(row):
-  # error handling? should be a digit between 0 and 99999
-  if '/#' in str(row['Parent Record']):
-    resource_id = (row['Parent Record'].partition('/#')[0].rpartition('/')[2])
-  else:
-    resource_id = (row['Parent Record'].partition('#')[0].rpartition('/')[2])
-  return resource_id
-
 def set_repository(first_row, api_url, sesh):
   repo_dict = get_repositories(api_url, sesh)
   if first_row[0] in repo_dict:
@@ -177,57 +254,100 @@ def set_action_type(input_file):
     raise FileNameError(input_file)
 
 def get_credentials(url, username, password):
-  if (url in (None, '')) or (username in (None, '')) or (password in (None, '')):
+  if not (url and username and password):
     url = input('Please enter the ArchivesSpace API URL: ')
     username = input('Please enter your username: ')
     password = input('Please enter your password: ')
   return url, username, password
 
+def mount_adapter(session, pool_connections, pool_maxsize):
+  from requests.adapters import HTTPAdapter
+  from urllib3.util.retry import Retry
+  # GETs are retried on gateway errors. POSTs are only retried if the connection couldn't be made,
+  # since retrying after a 504 could create the same records twice
+  retries = Retry(total=3, backoff_factor=0.3, status_forcelist=(502, 503, 504), allowed_methods=frozenset(['GET']), raise_on_status=False)
+  adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize, max_retries=retries)
+  session.mount('https://', adapter)
+  session.mount('http://', adapter)
+
 def start_session(url=None, username=None, password=None):
+  import requests
   url, username, password = get_credentials(url, username, password)
   session = requests.Session()
+  mount_adapter(session, pool_connections=32, pool_maxsize=64)
   session.headers.update({'Content_Type': 'application/json'})
-  auth_request = session.post(f"{url}/users/{username}/login?password={password}")
+  # the password goes in the request body, so it doesn't end up in the server's access logs
+  auth_request = session.post(f"{url}/users/{username}/login", data={'password': password})
   if auth_request.status_code == 200:
-    console.log(f'Login successful!: {url}')
+    get_console().log(f'Login successful!: {url}')
     logging.debug(f'Login successful!: {url}')
-    session_token = json.loads(auth_request.text)['session']
+    session_token = json_loads(auth_request.content)['session']
     session.headers['X-ArchivesSpace-Session'] = session_token
     return url, session
   else:
     raise LoginError(auth_request.status_code, url, username)
 
+# each worker thread keeps its own session, so that keep-alive connections aren't shared between threads
+thread_data = threading.local()
+
+def get_thread_session(sesh, pool_size):
+  import requests
+  if getattr(thread_data, 'session', None) is None:
+    session = requests.Session()
+    # reuses the login token from the main session rather than logging in again for every thread
+    session.headers.update(sesh.headers)
+    mount_adapter(session, pool_connections=pool_size, pool_maxsize=pool_size)
+    thread_data.session = session
+  return thread_data.session
+
 def get_record(url, sesh):
   record = sesh.get(url)
   if record.status_code == 200:
-    return json.loads(record.text)
+    return json_loads(record.content)
   else:
-    raise ArchivesSpaceError(url, record.status_code, json.loads(record.text))
+    raise ArchivesSpaceError(url, record.status_code, json_loads(record.content))
 
 def post_record(url, sesh, record_json):
   record = sesh.post(url, json=record_json)
   # what if the text cannot be converted to json? need to make sure it works
   if record.status_code == 200:
-    return json.loads(record.text)
+    return json_loads(record.content)
+  else:
+    raise ArchivesSpaceError(url, record.status_code, json_loads(record.content))
+
+def post_batch(url, sesh, batch):
+  # the batch_imports endpoint streams back a list of status messages; the last one maps each import URI to the saved record
+  record = sesh.post(url, json=batch)
+  if record.status_code == 200:
+    saved_uris = {}
+    for message in json_loads(record.content):
+      if 'errors' in message:
+        raise ArchivesSpaceError(url, record.status_code, {'error': message['errors']})
+      saved_uris.update(message.get('saved', {}))
+    return {import_uri: uris[0] for import_uri, uris in saved_uris.items()}
   else:
-    raise ArchivesSpaceError(url, record.status_code, json.loads(record.text))
+    raise ArchivesSpaceError(url, record.status_code, json_loads(record.content))
 
 def create_backups(dirpath, uri, record_json):
-  with open(f"{dirpath}/{uri[1:].replace('/','_')}.json", 'a', encoding='utf8') as outfile:
-    json.dump(record_json, outfile, sort_keys=True, indent=4)
+  with open(f"{dirpath}/{uri[1:].replace('/','_')}.json", 'ab') as outfile:
+    outfile.write(json_dumps(record_json))
 
 ### ArchivesSpace Stuff ###
 
 def get_repositories(api_url, sesh):
+  if cache_enabled and api_url in repository_cache:
+    return repository_cache[api_url]
   endpoint = f"{api_url}/repositories"
   try:
     repo_list = get_record(endpoint, sesh)
     repo_dict = {repo.get('repo_code'): str(repo.get('uri')[14:]) for repo in repo_list}
+    if cache_enabled:
+      repository_cache[api_url] = repo_dict
     return repo_dict
   except ArchivesSpaceError:
     # and don't return anything?
-    console.log(repo_list)
-    console.print_exception()
+    get_console().log(repo_list)
+    get_console().print_exception()
     logging.exception('Error: ')
     logging.debug(repo_list)
 
@@ -238,19 +358,28 @@ def get_uris(record_json):
       container_uri_list.append(instance['sub_container']['top_container']['ref'])
   return container_uri_list
 
-def generate_container_list(api_url, sesh, parent_json):
+def get_top_container(url, sesh):
+  if cache_enabled and url in top_container_cache:
+    return top_container_cache[url]
+  record_json = get_record(url, sesh)
+  if cache_enabled:
+    top_container_cache[url] = record_json
+  return record_json
+
+def generate_container_map(api_url, sesh, parent_json):
   # is it an ok idea to mix try/excepts and raising exceptions?
-  container_store = []
+  # returns a dict of container indicators and URIs, so each row's container can be looked up directly
+  container_store = {}
   container_uri_list = get_uris(parent_json)
   if container_uri_list:
     for container_uri in container_uri_list:
       container_uri = f"{api_url}{container_uri}"
       try:
-        record_json = get_record(container_uri, sesh)
-        container_store.append((record_json['uri'], record_json['indicator']))
+        record_json = get_top_container(container_uri, sesh)
+        container_store.setdefault(record_json['indicator'], record_json['uri']) ### if two containers share an indicator, the first one is used
       except ArchivesSpaceError:
-        console.log(record_json)
-        console.print_exception()
+        get_console().log(record_json)
+        get_console().print_exception()
         logging.exception('Error: ')
     return container_store
   else:
@@ -259,71 +388,101 @@ def generate_container_list(api_url, sesh, parent_json):
 def get_instance_data(api_url, sesh, record_json):
   # filters out digital object instances from the instance subrecord
   container_instances = [instance for instance in record_json.get('instances') if instance.get('instance_type') != 'digital_object']
-  # if there are items in the container list, the generate container list function is run to get the URI and the container number
+  # if there are any container instances, the generate container map function is run to get the URI for each container number
   if container_instances:
     try:
-      container_list = generate_container_list(api_url, sesh, record_json)
-      return container_list
+      container_map = generate_container_map(api_url, sesh, record_json)
+      return container_map
     except RecordNotFoundError:
       logging.exception('Error: ')
-      console.print_exception()
+      get_console().print_exception()
   else:
     raise RecordNotFoundError(record_json)
 
-def get_containers(api_url, sesh, parent_id, repo_id, container_list=None):
+def get_containers(api_url, sesh, parent_id, repo_id, container_map=None):
+  # rows in a spreadsheet often share a parent, so the container map is cached by parent record
+  if cache_enabled and (repo_id, parent_id) in container_cache:
+    return container_cache[(repo_id, parent_id)]
+  container_map = lookup_containers(api_url, sesh, parent_id, repo_id)
+  if cache_enabled and container_map is not None:
+    container_cache[(repo_id, parent_id)] = container_map
+  return container_map
+
+def prefetch_containers(api_url, sesh, repo_id, parent_ids, page_size=250):
+  # fetches the parent records in groups of page_size using id_set[], with their top containers resolved in the same
+  # request, and fills the container cache. Records without a container of their own (which need the ancestor check)
+  # and any failed requests are left for get_containers to look up as usual
+  parent_ids = [parent_id for parent_id in parent_ids if parent_id]
+  for i in range(0, len(parent_ids), page_size):
+    id_set = '&'.join(f'id_set[]={parent_id}' for parent_id in parent_ids[i:i + page_size])
+    try:
+      records = get_record(f"{api_url}/repositories/{repo_id}/archival_objects?{id_set}&resolve[]=top_container", sesh)
+    except ArchivesSpaceError:
+      logging.exception('Error: ')
+      continue
+    for record_json in records:
+      container_store = {}
+      for instance in record_json.get('instances', []):
+        if instance.get('instance_type') != 'digital_object':
+          top_container = instance['sub_container']['top_container'].get('_resolved')
+          if top_container:
+            container_store.setdefault(top_container['indicator'], top_container['uri'])
+      if container_store:
+        container_cache[(repo_id, record_json['uri'].rpartition('/')[2])] = container_store
+
+def lookup_containers(api_url, sesh, parent_id, repo_id):
   # if there's an 'error' returned, the status code would not be 200, correct? try passing in a bum uri and find out
   try:
     record_url = f"{api_url}/repositories/{repo_id}/archival_objects/{parent_id}"
     record_json = get_record(record_url, sesh)
     try:
-      container_list = get_instance_data(api_url, sesh, record_json)
-      return container_list
+      container_map = get_instance_data(api_url, sesh, record_json)
+      return container_map
     except RecordNotFoundError:
       try:
       # if there isn't a container linked to the object, it checks the parent for a container
         parent_url = f"{api_url}/{record_json['ancestors'][0]['ref']}"
         parent_json = get_record(parent_url, sesh)
         try:
-          container_list = get_instance_data(api_url, sesh, parent_json)
-          return container_list
+          container_map = get_instance_data(api_url, sesh, parent_json)
+          return container_map
         except RecordNotFoundError:
           logging.exception('Error: ')
-          console.print_exception()
+          get_console().print_exception()
       except ArchivesSpaceError:
         logging.exception('Error: ')          
-        console.print_exception()
+        get_console().print_exception()
   # need to make sure this works if there's a bad response - also just not sure if it's the right thing to do, just to get the message
   except (ArchivesSpaceError, RecordNotFoundError):
     logging.exception('Error: ')
-    console.print_exception()
+    get_console().print_exception()
 
-def match_containers(container_list, container_number):
-  for uri, indicator in container_list:
-    if indicator == container_number:
-      return uri
-  else:
+def match_containers(container_map, container_number):
+  try:
+    return container_map[container_number]
+  except KeyError:
     raise RecordNotFoundError(container_number)
 
 def get_current_user(api_url, sesh):
   # don't have any error handling here...but if the login worked this should work
-  current_user = sesh.get(f"{api_url}/users/current-user").json()
+  current_user = json_loads(sesh.get(f"{api_url}/users/current-user").content)
   return current_user['agent_record']['ref']
 
 def set_agent(api_url, sesh, agent_authorizer, username):
-  if (agent_authorizer not in ("", None) and agent_authorizer != username):
-    search_agents = sesh.get(f"{api_url}/search?page=1&type[]=agent_person&q=title:{agent_authorizer}").json()
+  if (agent_authorizer and agent_authorizer != username):
+    search_agents = json_loads(sesh.get(f"{api_url}/search?page=1&type[]=agent_person&q=title:{agent_authorizer}").content)
     if search_agents.get('total_hits') == 1:
       return search_agents['results'][0]['uri']
     elif search_agents.get('total_hits') == 0:
-      console.log('Agent search error: no results found')
+      get_console().log('Agent search error: no results found')
       logging.debug('Agent search error: no results found')
       raise RecordNotFoundError(agent_authorizer)
     elif search_agents.get('total_hits') > 1:
-      console.log('Agents search error: multiple results found')
+      get_console().log('Agents search error: multiple results found')
       logging.debug('Agents search error: multiple results found')
       raise RecordNotFoundError(agent_authorizer)
     else:
-      console.log('Agent search error: other error')
+      get_console().log('Agent search error: other error')
       logging.debug('Agent search error: other error')
       raise ArchivesSpaceError(url, search_agents)
   else:
@@ -337,85 +496,85 @@ def create_instance(container_uri):
 
 def update_extents(row):
   new_extent_list = []
-  if row['Type_1'] != '':
+  if row.get('Type_1'):
     first_extent = { "number": '1', "portion": "whole", "extent_type": row['Type_1'], "jsonmodel_type": "extent"}
     new_extent_list.append(first_extent)
-  if row['Number_of_bytes'] != '':
+  if row.get('Number_of_bytes'):
     second_extent = { "number": row['Number_of_bytes'].replace(',', ''), "portion": "whole", "extent_type": 'bytes', "jsonmodel_type": "extent"}
     # no container summary available for the first extent?
-    if row['Container_Summary'] != '':
+    if row.get('Container_Summary'):
       second_extent['container_summary'] = row['Container_Summary']
     new_extent_list.append(second_extent)
   return new_extent_list
 
+# accepted date formats, mapped to the (year, month, day) group numbers. Two-digit years follow the same rule as strptime's %y
+DATE_PATTERNS = ((re.compile(r'(\d{4})-(\d{1,2})-(\d{1,2})'), (1, 2, 3)), # YYYY-MM-DD
+                 (re.compile(r'(\d{1,2})/(\d{1,2})/(\d{4})'), (3, 1, 2)), # MM/DD/YYYY
+                 (re.compile(r'(\d{4})/(\d{1,2})/(\d{1,2})'), (1, 2, 3)), # YYYY/MM/DD
+                 (re.compile(r'(\d{1,2})/(\d{1,2})/(\d{2})'), (3, 1, 2)), # MM/DD/YY
+                 (re.compile(r'(\d{1,2})-(\d{1,2})-(\d{2})'), (3, 1, 2))) # MM-DD-YY
+
 def check_dates(date_value):
-  if '/' in date_value:
-    last_value = date_value.split('/')[-1]
-    first_value = date_value.split('/')[0]
-    if len(last_value) == 4:
-      # this should be a 4 digit year and easy enough to fix
-      return datetime.strptime(date_value, '%m/%d/%Y').strftime('%Y-%m-%d')
-    if len(last_value) == 2:
-      if len(first_value) != 4:
-        return datetime.strptime(date_value, '%m/%d/%y').strftime('%Y-%m-%d')
-      else:
-        return datetime.strptime(date_value, '%Y/%m/%d').strftime('%Y-%m-%d')
-    else:
-      raise DataValidationError(date_value, 'YYYY-MM-DD')
-  elif ('-' in date_value and '/' not in date_value):
-    if len(date_value) < 10:
-      # hmm not sure about this. Like, i don't think it's right
-      return datetime.strptime(date_value, '%m-%d-%y').strftime('%Y-%m-%d')
-  else:
-    raise DataValidationError(date_value, 'YYYY-MM-DD')
+  for pattern, (year, month, day) in DATE_PATTERNS:
+    match = pattern.fullmatch(date_value.strip())
+    if match:
+      year_value = int(match[year])
+      if len(match[year]) == 2:
+        year_value += 2000 if year_value < 69 else 1900
+      try:
+        # date() is only used to reject impossible dates like 13/45/2022
+        return date(year_value, int(match[month]), int(match[day])).isoformat()
+      except ValueError:
+        break
+  raise DataValidationError(date_value, 'YYYY-MM-DD')
 
-def create_event(agent_uri, ao_id, repo_id, event_type, outcome, date_value, outcome_note):
+def create_event(agent_uri, record_uri, event_type, outcome, date_value, outcome_note):
   try:
     date_value = check_dates(date_value)
     return {"event_type": event_type.lower(), "jsonmodel_type": "event", "outcome": outcome.lower(),
               "outcome_note": outcome_note, "linked_agents": [{ "role": "authorizer", "ref": agent_uri}],
-              "linked_records": [{ "role": "source", "ref": f'/repositories/{repo_id}/archival_objects/{ao_id}'}],
+              "linked_records": [{ "role": "source", "ref": record_uri}],
               "date": { "begin": date_value, "date_type": "single", "label": "event", "jsonmodel_type": "date"}}
   except DataValidationError:
-    console.print_exception()
+    get_console().print_exception()
     logging.exception('Error: ')
 
-def event_helper(api_url, sesh, agent_uri, record_uri, repo_id, event_type, outcome, begin_date, outcome_note):
-  try:
-    new_event = create_event(agent_uri, record_uri, repo_id, event_type, outcome, begin_date, outcome_note)
-    if new_event:
-      event_json = post_record(f"{api_url}/repositories/{repo_id}/events", sesh, new_event)
-      return event_json.get('uri')
-    else:
-      # this is sort of redundant, might want to remove
-      raise DataValidationError(new_event, '')
-  except (DataValidationError, ArchivesSpaceError):
-    logging.exception('Error: ')
-    console.print_exception()
+def batch_events(row, agent_uri, repo_id, record_uri, row_number=0):
+  # builds the events for a row without posting them, so they can all go to the batch_imports endpoint in one request.
+  # Each event gets its own import URI, which is swapped for the real URI once the batch is saved
+  events = {}
+  for n in (1, 2, 3):
+    if row.get(f'Event_Type_{n}'):
+      new_event = create_event(agent_uri, record_uri, row[f'Event_Type_{n}'], row[f'Outcome_{n}'], row[f'Begin_{n}'], row[f'Outcome_Note_{n}'])
+      if new_event:
+        new_event['uri'] = f"/repositories/{repo_id}/events/import_{row_number}_{n}"
+        events[f'Event_URI_{n}'] = new_event
+  return events
 
 def post_events(row, agent_uri, repo_id, record_uri, api_url, sesh):
-  event_uris = {}
+  # used for updated records; events for new records go out in the same batch as the record itself
   try:
-    if row['Event_Type_1'] not in ('', None):
-      new_event_uri = event_helper(api_url, sesh, agent_uri, record_uri, repo_id, row['Event_Type_1'], row['Outcome_1'], row['Begin_1'], row['Outcome_Note_1'] )
-      event_uris['Event_URI_1'] = new_event_uri
-    if row['Event_Type_2'] not in ('', None):
-      new_event_uri = event_helper(api_url, sesh, agent_uri, record_uri, repo_id, row['Event_Type_2'], row['Outcome_2'], row['Begin_2'], row['Outcome_Note_2'] )
-      event_uris['Event_URI_2'] = new_event_uri
-    if row['Event_Type_3'] not in ('', None):
-      new_event_uri = event_helper(api_url, sesh, agent_uri, record_uri, repo_id, row['Event_Type_3'], row['Outcome_3'], row['Begin_3'], row['Outcome_Note_3'] )
-      event_uris['Event_URI_3'] = new_event_uri
-    return event_uris
-  except (ArchivesSpaceError, DataValidationError):
+    new_events = batch_events(row, agent_uri, repo_id, record_uri)
+    if new_events:
+      saved_uris = post_batch(f"{api_url}/repositories/{repo_id}/batch_imports", sesh, list(new_events.values()))
+      return {key: saved_uris.get(event['uri']) for key, event in new_events.items()}
+    return {}
+  except ArchivesSpaceError:
     logging.exception('Error: ')
-    console.print_exception()
+    get_console().print_exception()
+    return {}
 
-def get_uris(record_json):
-  container_uri_list = []
-  for instance in record_json.get('instances'):
-    if instance.get('instance_type') != 'digital_object':
-      container_uri_list.append(instance['sub_container']['top_container']['ref'])
-  return container_uri_list
+def save_batch(api_url, sesh, repo_id, batch, batch_rows):
+  # returns the rows in the batch, with their import URIs replaced by the URIs of the saved records
+  saved_uris = post_batch(f"{api_url}/repositories/{repo_id}/batch_imports", sesh, batch)
+  for row, import_uris in batch_rows:
+    row.update({key: saved_uris.get(import_uri) for key, import_uri in import_uris.items()})
+  return [row for row, import_uris in batch_rows]
+
+def flush_rows(writer, outfile, pending):
+  writer.writerows(pending)
+  outfile.flush()
+  pending.clear()
 
 def update_archival_object(api_url, sesh, row, ao_id, repo_id, dirpath):
   record_uri = f"{api_url}/repositories/{repo_id}/archival_objects/{ao_id}"
@@ -424,7 +583,7 @@ def update_archival_object(api_url, sesh, row, ao_id, repo_id, dirpath):
     create_backups(dirpath, f"/repositories/{repo_id}/archival_objects/{ao_id}", record_json)
     record_json['component_id'] = row['Component Unique ID'] # updates with the new component ID  
     record_json['extents'] = update_extents(row) # runs the update_extents function to create the new extents. Replaces any existing extents
-    if row['Top Container'] not in ('', None):
+    if row.get('Top Container'):
       current_container_uris = get_uris(record_json) # Getting a list of top container URIs currently linked to the record. A lot of times this will be the same as the container lookup that happened before, but not always, since the container lookup will also check the parent
       if row['Top Container'] not in current_container_uris: # checks if the container that is listed in the Top Container field is in the instance field - this might not be the case if the box is linked to the parent
         new_instance = create_instance(row['Top Container']) # if there isn't already a container instance, make one; note that nothing is deleted, so if there's a container listed at the parent level it will still be there. Should maybe fix that?
@@ -433,7 +592,7 @@ def update_archival_object(api_url, sesh, row, ao_id, repo_id, dirpath):
     return record_json, endpoint
   except ArchivesSpaceError:
     logging.exception('Error: ')
-    console.print_exception()
+    get_console().print_exception()
 
 def create_archival_object(row, repo_id, parent_id, resource_id):
   new_archival_object = {"publish": True, "title": row['Title'], "level": "item",
@@ -443,7 +602,7 @@ def create_archival_object(row, repo_id, parent_id, resource_id):
   if row['Title'] == '':
     new_archival_object['title'] = '[no label]'
   new_archival_object['extents'] = update_extents(row)
-  if row['Top Container'] not in ('', None):
+  if row.get('Top Container'):
       new_instance = create_instance(row['Top Container'])
       new_archival_object['instances'].append(new_instance)
   endpoint = f"/repositories/{repo_id}/archival_objects"
@@ -456,14 +615,14 @@ def get_action(input_file):
     return set_action_type(input_file)
   except FileNameError as err:
     logging.exception(err)
-    console.print_exception()
+    get_console().print_exception()
 
 def get_session(url, username, password):
   try:
     return start_session(url, username, password)
   except LoginError as err:
     logging.exception(err)
-    console.print_exception()
+    get_console().print_exception()
 
 def get_repo(row, api_url, sesh):
   try:
@@ -471,57 +630,135 @@ def get_repo(row, api_url, sesh):
     return set_repository(row, api_url, sesh)
   except (ArchivesSpaceError, RecordNotFoundError) as err:
     logging.exception(err)
-    console.print_exception()
+    get_console().print_exception()
 
 def get_agent(api_url, sesh, agent_authorizer, username):
   try:
     return set_agent(api_url, sesh, agent_authorizer, username)
   except (ArchivesSpaceError, RecordNotFoundError) as err:
     logging.exception(err)
-    console.print_exception()
+    get_console().print_exception()
   
-def get_matched_containers(container_list, container_number):
+def get_matched_containers(container_map, container_number):
   try:
-    return match_containers(container_list, container_number)
+    return match_containers(container_map, container_number)
   except Exception as err:
-    console.log(container_list)
-    console.print_exception()
+    get_console().log(container_map)
+    get_console().print_exception()
     logging.exception(err)
-    logging.debug(container_list)
+    logging.debug(container_map)
   
-def skip_rows(reader, number_of_rows=2):
-  for i in range(number_of_rows):
-    next(reader)
-  return reader
+def process_row(row_number, row, api_url, sesh, workers, is_update, repo_identifier, agent_uri, previous_container, container_map, dirpath):
+  # does all of the lookups and posts for a single row, so that rows can be run in parallel. Returns the row along
+  # with any new records that still need to be sent to the batch_imports endpoint, and their import URIs
+  import requests
+  sesh = get_thread_session(sesh, workers)
+  resource_identifier, record_id = parse_parent_record(row['Parent Record']) ### extracts the resource and archival object identifiers from the ArchivesSpace URL
+  if row['Parent Record'].strip():
+    try:
+      # a Parent Record that doesn't parse is a data entry error, not a blank row, so it stops the file like any other failed row
+      if not record_id:
+        raise DataValidationError(row['Parent Record'], '.../resources/1234#tree::archival_object_56789')
+      if not is_update and not resource_identifier:
+        raise DataValidationError(row['Parent Record'], '.../resources/1234#tree::archival_object_56789', 'Missing resource identifier! New records need the resource in the Parent Record URL.')
+      # we know that sometimes the top container field will not be filled out.
+      if row.get('Top Container'):
+        if row['Top Container'] != previous_container: ### if the number of the container is not the same as the first container
+          container_map = get_containers(api_url, sesh, record_id, repo_identifier) ### do the lookup again
+        # don't need a try block here because the get_matched_containers function already has one
+        row['Top Container'] = get_matched_containers(container_map, row['Top Container']) ### match the container number with the URI, and replace the indicator value with the URI
+      # this if/else block uses the action to run the correct function. Updated records are posted right away, while
+      # created records are returned with their events so they can be batched
+      if is_update:
+        record_json, endpoint = update_archival_object(api_url, sesh, row, record_id, repo_identifier, dirpath)
+        record_post = post_record(f"{api_url}{endpoint}", sesh, record_json)
+        row['New_Component_URI'] = record_post.get('uri')
+        event_uris = post_events(row, agent_uri, repo_identifier, record_post.get('uri'), api_url, sesh)
+        row.update(event_uris)
+        return row, [], {}
+      else:
+        record_json, endpoint = create_archival_object(row, repo_identifier, record_id, resource_identifier)
+        import_uri = f"/repositories/{repo_identifier}/archival_objects/import_{row_number}" ### placeholder URI; the events link to it, and ArchivesSpace swaps in the real URI when the batch is saved
+        record_json['uri'] = import_uri
+        new_events = batch_events(row, agent_uri, repo_identifier, import_uri, row_number)
+        import_uris = {'New_Component_URI': import_uri, **{key: event['uri'] for key, event in new_events.items()}}
+        return row, [record_json, *new_events.values()], import_uris
+    except (ArchivesSpaceError, DataValidationError, requests.exceptions.RequestException):
+      logging.debug(row)
+      get_console().log(row)
+      raise
+  else:
+    get_console().log('Skipping row: missing Aspace URI')
+    get_console().log(row)
+    logging.debug('Skipping row: missing ASpace URI')
+    logging.debug(row)
+
+def process_rows(executor, row_worker, rows, workers):
+  # runs the rows on the pool with at most `workers` in flight, so the file is read as it's processed, and yields
+  # (result, error) pairs in the same order as the input file. Once a row fails no new rows are started, but the rows
+  # that are already running are finished and yielded too, since they may have already changed records in ArchivesSpace
+  rows = iter(rows)
+  in_flight = deque(executor.submit(row_worker, *numbered_row) for numbered_row in islice(rows, workers))
+  failed = False
+  while in_flight:
+    future = in_flight.popleft()
+    try:
+      result = future.result()
+    except Exception as err:
+      failed = True
+      yield None, err
+      continue
+    if not failed:
+      next_row = next(rows, None)
+      if next_row is not None:
+        in_flight.append(executor.submit(row_worker, *next_row))
+    yield result, None
 
 def move_files_helper(values, key):
-  for source_path in values:
-    #FIX
-    dest_path = source_path.replace('aspace_spreadsheets_all_repos/', f'aspace_spreadsheets_all_repos/{key}/')
+  moves = {source_path: source_path.replace('aspace_spreadsheets_all_repos/', f'aspace_spreadsheets_all_repos/{key}/') for source_path in values}
+  for dest_dir in {os.path.dirname(dest_path) for dest_path in moves.values()}:
+    os.makedirs(dest_dir, exist_ok=True)
+  for source_path, dest_path in moves.items():
     logging.debug(f"Moving: {source_path} --> {dest_path}")
-    shutil.move(source_path, dest_path)
+    try:
+      # a rename is all that's needed when the source and destination are on the same drive
+      os.replace(source_path, dest_path)
+    except OSError:
+      shutil.move(source_path, dest_path)
 
 def move_files(file_results, drive_path):
+  # each file only goes to one folder - a file with errors is also listed as complete, but should end up in errors
+  errors = set(file_results.get('errors', []))
   for key, values in file_results.items():
     if key == 'complete':
-      move_files_helper(values, key)
+      move_files_helper([value for value in dict.fromkeys(values) if value not in errors], key)
     elif key == 'errors':
-      move_files_helper(values, key)
+      move_files_helper(dict.fromkeys(values), key)
 
 def main(results=False):
+  import requests
+  from rich.progress import track
   try:
     config = get_config() ### load the configuration 
     drive_path = config.get('network_drive_path')
     setup_logging(f"{drive_path}/logs")
     file_listing = get_spreadsheet_list(drive_path)
     file_results = defaultdict(list)
+    batch_size = config.get('batch_size', 200) ### number of new archival objects to send to ArchivesSpace per batch_imports request
+    workers = config.get('workers', 8) ### number of rows to process at the same time
+    output_batch_size = config.get('output_batch_size', 500) ### number of rows to write to the outfile at a time
+    set_cache(not config.get('no_cache', False)) ### repository and container lookups are cached unless no_cache is set
     api_url, sesh = get_session(config.get('api_url'), config.get('username'), config.get('password')) ### Log in to the ArchivesSpace API and start a session
     for input_csv_file in file_listing:
       logging.debug(input_csv_file)
-      console.log(input_csv_file)
+      get_console().log(input_csv_file)
       output_csv_file = f"{input_csv_file.replace('.csv', '').replace(drive_path, f'{drive_path}/outputs')}_out.csv" ###
       row_count, first_row = get_row_data(input_csv_file) ### Retrieve the number of rows, for use in the progress bar. Also retrieve the first row, which is used to generate the repository and resource identifiers
       action = get_action(input_csv_file) ### checks the input file for the presence of 'create' or 'update' in the filename, and chooses the function to run based on that. If neither word is present an exception is raised
+      if action is None: ### get_action has already logged the bad filename, so just skip the file
+        file_results['errors'].append(input_csv_file)
+        continue
+      is_update = action is update_archival_object ### checked once here, rather than for every row
       # don't need a try block here because the get_session function already has one
       # if the username and password are different....
       # need to change this, as this is not always the
@@ -530,65 +767,76 @@ def main(results=False):
       agent_identifier = config.get('event_authorizer')
       # don't need a try block here because the get_agent function already has one
       agent_uri = get_agent(api_url, sesh, agent_identifier, config.get('username')) ### Set the agent URI - this allows the user to assign a different agent authorizer, other than themselves)
-      fieldnames = set_fieldnames() ### Set fieldnames for the input and output CSV files - required for the csv.DictReader and csv.DictWriter classes
-      new_fieldnames = set_fieldnames(extras=True) ###
       previous_container = first_row[8] ### Store the first top container indicator
+      container_map = None
       # ...not sure about this - did have a wrapper function w a try/except, but I think I covered with
       # the changes I made to get containers. But maybe I should have kept all the raises
       # and then just had the wrapper function???
-      if previous_container != '':
-        container_list = get_containers(api_url, sesh, parent_identifier, repo_identifier) ### get a container list for the first row. This checks the record itself and the parent
-      with open(input_csv_file, encoding='utf8') as infile, open(output_csv_file, 'a', encoding='utf8') as outfile: ### Open the input and output files
-        reader = csv.DictReader(infile, fieldnames=fieldnames) ### Open the CSV as a dictionary
-        reader = skip_rows(reader) ### skip the first two rows
-        writer = csv.DictWriter(outfile, fieldnames=new_fieldnames) ### Open the output CSV file, also as a dictionary, with some extra columns that aren't in the input CSV
+      if cache_enabled:
+        prefetch_containers(api_url, sesh, repo_identifier, get_container_parents(input_csv_file)) ### resolve the containers for every row in a few requests, rather than one lookup per parent
+      if previous_container:
+        container_map = get_containers(api_url, sesh, parent_identifier, repo_identifier) ### get the container map for the first row. This checks the record itself and the parent
+      with open(input_csv_file, encoding='utf8') as infile, open(output_csv_file, 'a', buffering=1048576, encoding='utf8') as outfile: ### Open the input and output files
+        reader = csv.DictReader(infile, fieldnames=FIELDNAMES) ### Open the CSV as a dictionary
+        deque(islice(reader, 2), maxlen=0) ### skip the first two rows
+        writer = csv.DictWriter(outfile, fieldnames=FIELDNAMES_EXTRAS) ### Open the output CSV file, also as a dictionary, with some extra columns that aren't in the input CSV
         writer.writeheader()
-        for row in track(reader, total=row_count): ### Loop through the input CSV. The track function initializes a progress bar
-          resource_identifier = set_resource(row)
-          record_id = row['Parent Record'].rpartition("_")[2] ### extracts the archival object identifier from the ArchivesSpace URL
-          if record_id not in ('', None):
-            # we know that sometimes the top container field will not be filled out.
-            if row['Top Container'] != '':
-              if row['Top Container'] != previous_container: ### if the number of the container is not the same as the last container
-                container_list = get_containers(api_url, sesh, record_id, repo_identifier) ### do the lookup again
-              # don't need a try block here because the get_matched_containers function already has one
-              row['Top Container'] = get_matched_containers(container_list, row['Top Container']) ### match the container number with the URI, and replace the indicator value with the URI
-            # this if/else block uses the result of the get_action function above to run the correct function; returns the updated or created records
-            # and the endpoint to post to (either the existing URi or the /archival_objects endpoint)
-            if 'update_archival_object' in str(action):
-              record_json, endpoint = update_archival_object(api_url, sesh, row, record_id, repo_identifier, f"{drive_path}/backups")
-            elif 'create_archival_object' in str(action):
-              record_json, endpoint = create_archival_object(row, repo_identifier, record_id, resource_identifier)
-            try:
-              record_post = post_record(f"{api_url}{endpoint}", sesh, record_json)
-              row['New_Component_URI'] = record_post.get('uri')
-              event_uris = post_events(row, agent_uri, repo_identifier, record_post.get('uri'), api_url, sesh)
-              row.update(event_uris)
-              writer.writerow(row)
-            except (ArchivesSpaceError, requests.exceptions.RequestException) as err:
-              logging.exception(err)
-              logging.debug(row)
-              console.log(row)
-              console.print_exception()
-              file_results['errors'].append(input_csv_file)
-              # THIS IS NEW: the script will stop reading the file if there is an error. It will break out of the loop 
-              # and move on to the next file. That is better than 
-              break
-          else:
-            console.log('Skipping row: missing Aspace URI')
-            console.log(row)
-            logging.debug('Skipping row: missing ASpace URI')
-            logging.debug(row)
+        pending = [] ### finished rows are held here and written to the outfile output_batch_size rows at a time
+        batch, batch_rows = [], [] ### new archival objects and their events are collected here and sent to the batch_imports endpoint batch_size rows at a time
+        row_worker = partial(process_row, api_url=api_url, sesh=sesh, workers=workers, is_update=is_update, repo_identifier=repo_identifier, agent_uri=agent_uri,
+                             previous_container=previous_container, container_map=container_map, dirpath=f"{drive_path}/backups")
+        # rows are processed by a pool of worker threads, but the results come back in the same order as the input file,
+        # so only this thread writes to the outfile and no lock is needed
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+          try:
+            error = None
+            for result, row_error in track(process_rows(executor, row_worker, enumerate(reader), workers), total=row_count): ### Loop through the processed rows. The track function initializes a progress bar
+              if row_error is not None:
+                if error is None:
+                  error = row_error
+                else:
+                  logging.error(f'Another row also failed: {row_error}')
+                continue
+              if result is None:
+                continue
+              row, new_records, import_uris = result
+              if new_records:
+                if error is not None: ### rows after the failed row are not created
+                  continue
+                batch.extend(new_records)
+                batch_rows.append((row, import_uris))
+                if len(batch_rows) >= batch_size:
+                  pending.extend(save_batch(api_url, sesh, repo_identifier, batch, batch_rows))
+                  batch, batch_rows = [], []
+              else:
+                pending.append(row) ### updated rows are always written, even after a failure, since the update has already been made
+              if len(pending) >= output_batch_size:
+                flush_rows(writer, outfile, pending)
+            if batch_rows:
+              pending.extend(save_batch(api_url, sesh, repo_identifier, batch, batch_rows)) ### includes the rows before a failed row
+            if error is not None:
+              raise error
+          except (ArchivesSpaceError, DataValidationError, requests.exceptions.RequestException) as err:
+            # when a row fails, no more rows are started; the rows that were already running are finished and written
+            logging.exception(err)
+            get_console().print_exception()
+            file_results['errors'].append(input_csv_file)
+            # THIS IS NEW: the script will stop reading the file if there is an error. It will break out of the loop 
+            # and move on to the next file. Rows in a batch that failed are not written to the outfile, since
+            # ArchivesSpace saves all or none of a batch
+          finally:
+            flush_rows(writer, outfile, pending) ### rows that were saved before any error still go in the outfile
       file_results['complete'].append(input_csv_file)  
     logging.debug('Done! Check outfile for details.')
-    console.log('Done! Check log and outfile for details.')
+    get_console().log('Done! Check log and outfile for details.')
     results = True
   except Exception as exc:
-    console.print(row)
+    get_console().print(row)
     logging.exception(exc)
     logging.debug(row)
   finally:
     move_files(file_results, drive_path)
+    import send_notifications
     send_notifications.send_it(success=results)
 
 if __name__ == "__main__":
@@ -1,15 +1,13 @@
 #/usr/bin/python3
 
-from datetime import datetime
-import json
-import smtplib
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
-from email.mime.image import MIMEImage
-import traceback
-import yaml
+from dataclasses import dataclass
+from datetime import date
+from functools import lru_cache
+import os
+import re
+import logging
 
-#import copy_order_logging
+# the mail and yaml modules are only loaded when an email is actually sent
 
 '''Sends email notifications when orders are ready to send
 
@@ -17,30 +15,54 @@ Includes log file as an attachment
 
 '''
 
-#log = copy_order_logging.get_logger(__name__)
+# logs go through the standard logging module - when this runs from dass_born_digital_accessioning_tool,
+# they end up in the same debug and error logs as the rest of the run
+log = logging.getLogger(__name__)
+
+# the parsed config.yml, along with its path and modification time, so it's only parsed again if the file changes
+cfg_cache = {'key': None, 'cfg': None}
+
+@lru_cache(maxsize=1)
+def get_ssl_context():
+    # loading the CA certificates is the slow part of making a context, and one context can be shared by every connection
+    import ssl
+    return ssl.create_default_context()
 
 def setup_smtp(email_pw, email_address):
+    import smtplib
     try:
-        smtp_object = smtplib.SMTP('smtp.gmail.com', 587)
-        smtp_object.ehlo()
-        smtp_object.starttls()
+        # implicit TLS on port 465 skips the plain-text EHLO and STARTTLS round trips that port 587 needs
+        smtp_object = smtplib.SMTP_SSL('smtp.gmail.com', 465, context=get_ssl_context())
         smtp_object.login(email_address, email_pw)
         return smtp_object
-    except Exception as e:
-        print(e)
-        #log.error(e)
+    except Exception:
+        log.exception('SMTP setup failed')
+
+def close_smtp(smtp_obj):
+    # the connection may already have been dropped by the server, in which case there's nothing left to close
+    import smtplib
+    if smtp_obj is not None:
+        try:
+            smtp_obj.quit()
+        except (smtplib.SMTPException, OSError):
+            pass
 
-def prep_message(message_to_send, email_address, recipient, logfile):
-    msg = MIMEMultipart()
-    msg['Subject'] = f"DASS ArchivesSpace update status {str(datetime.now()).split(' ')[0]}"
+def prep_message(message_to_send, email_address, recipient, logfile, compress_over=64 * 1024):
+    from email.message import EmailMessage
+    msg = EmailMessage()
+    msg['Subject'] = f"DASS ArchivesSpace update status {date.today().isoformat()}"
     msg['From'] = email_address
     msg['To'] = recipient
-    text = MIMEText(message_to_send, 'plain')
-    msg.attach(text)
+    msg.set_content(message_to_send)
     if logfile:
-        log_data = MIMEText(logfile)
-        log_data.add_header('Content-Disposition', 'attachment', filename='log.log')
-        msg.attach(log_data)
+        log_data = logfile if isinstance(logfile, bytes) else logfile.encode('utf8')
+        if len(log_data) > compress_over:
+            # text logs shrink 5-10x with gzip, which more than makes up for the base64 encoding of the attachment.
+            # Small logs are attached as plain text, so they can be read right in the email
+            import gzip
+            msg.add_attachment(gzip.compress(log_data, compresslevel=6), maintype='application', subtype='gzip', filename='log.log.gz')
+        else:
+            msg.add_attachment(log_data, maintype='text', subtype='plain', filename='log.log')
     return msg
 
 '''Make these messages more informative - i.e. include the number of orders ready to be sent'''
@@ -51,30 +73,127 @@ def success_message():
 def failure_message():
     return '''ArchivesSpace update failed. See attached logs for details.'''
 
-def get_log():
-    logfile = open('logs/errors.log')
-    return logfile.read()
+def get_log(max_bytes=5 * 1024 * 1024):
+    # read as bytes with a large buffer, so the log can be attached without decoding and re-encoding it.
+    # Only the last max_bytes are read - the most recent errors are the relevant ones, and Gmail rejects messages over 25 MB
+    with open('logs/errors.log', 'rb', buffering=1 << 20) as logfile:
+        size = logfile.seek(0, os.SEEK_END)
+        start = max(0, size - max_bytes)
+        logfile.seek(start)
+        if hasattr(os, 'posix_fadvise'):
+            # tells the kernel the file will be read straight through, so it can read ahead
+            os.posix_fadvise(logfile.fileno(), start, 0, os.POSIX_FADV_SEQUENTIAL)
+        if start:
+            logfile.readline() # skips the partial line at the cut
+        return logfile.read()
+
+# only recipient and recipient_1, recipient_2... count as recipient keys, so something like no_recipient_alerts doesn't
+RECIPIENT_KEY = re.compile(r'recipient(_\d+)?')
+
+@dataclass(frozen=True)
+class NotificationConfig:
+    status_email_address: str
+    status_email_password: str
+    recipients: tuple
+    smtp_batch_size: int = 100
+    smtp_messages_per_connection: int = 100
+
+    @classmethod
+    def from_dict(cls, cfg):
+        # checked once when config.yml is loaded, so send_it only has to read attributes
+        if not cfg.get('status_email_address'):
+            raise ValueError('status_email_address is not set in config.yml')
+        return cls(status_email_address=cfg['status_email_address'],
+                   status_email_password=cfg.get('status_email_password'),
+                   recipients=get_recipients(cfg),
+                   smtp_batch_size=int(cfg.get('smtp_batch_size', 100)),
+                   smtp_messages_per_connection=int(cfg.get('smtp_messages_per_connection', 100)))
+
+def get_recipients(cfg):
+    # recipients can be listed under a single recipients key, or as separate recipient_1, recipient_2... keys
+    if 'recipients' in cfg:
+        recipients = cfg['recipients'] or []
+    else:
+        recipients = [value for key, value in cfg.items() if RECIPIENT_KEY.fullmatch(key)]
+    # blank entries from the config template are skipped
+    return tuple(recipient for recipient in recipients if recipient)
+
+def send_in_batches(smtp_obj, email_pw, email_address, recipients, message_bytes, batch_size=100, messages_per_connection=100, retries=3):
+    # Gmail takes at most 100 recipients per message, so a long recipient list is split across several messages.
+    # The connection is replaced after messages_per_connection sends, to stay under the provider's per-connection limit
+    import smtplib
+    import socket
+    import time
+    sent = 0
+    try:
+        for i in range(0, len(recipients), batch_size):
+            if sent >= messages_per_connection:
+                close_smtp(smtp_obj)
+                smtp_obj = setup_smtp(email_pw, email_address)
+                sent = 0
+            # dropped connections are retried with a fresh login and exponential backoff. Anything else, like a
+            # rejected recipient, is raised right away
+            for attempt in range(retries):
+                try:
+                    smtp_obj.sendmail(email_address, list(recipients[i:i + batch_size]), message_bytes)
+                    break
+                except (smtplib.SMTPServerDisconnected, ConnectionResetError, socket.timeout):
+                    if attempt == retries - 1:
+                        raise
+                    log.warning(f'Lost connection to the SMTP server, retrying in {2 ** attempt} seconds', exc_info=True)
+                    time.sleep(2 ** attempt)
+                    # if logging in again fails, the old connection is kept so the next attempt fails and retries too
+                    new_smtp = setup_smtp(email_pw, email_address)
+                    if new_smtp is not None:
+                        close_smtp(smtp_obj)
+                        smtp_obj = new_smtp
+            sent += 1
+    except Exception:
+        # the caller only has the connection it passed in, so whichever connection is current when sending fails
+        # is closed here
+        close_smtp(smtp_obj)
+        raise
+    return smtp_obj
+
+def load_cfg(config_path='config.yml'):
+    # parsed once per process - later calls only stat the file, and parse it again if it has changed since
+    config_mtime = os.stat(config_path).st_mtime
+    if (config_path, config_mtime) != cfg_cache['key']:
+        import yaml
+        # opened in binary mode and passed as a file, so libyaml decodes and reads it in chunks itself
+        with open(config_path, 'rb') as file_path:
+            # the libyaml-based loader is much faster than the pure Python one, if it's available
+            cfg_cache['cfg'] = NotificationConfig.from_dict(yaml.load(file_path, Loader=getattr(yaml, 'CSafeLoader', yaml.SafeLoader)))
+            cfg_cache['key'] = (config_path, config_mtime)
+    return cfg_cache['cfg']
 
 def send_it(success=True, logfile=None):
+    from email.policy import SMTP
     try:
-        with open('config.yml') as file_path:
-            cfg = yaml.safe_load(file_path.read())
-            email_pw = cfg.get('status_email_password')
-            email_address = cfg.get('status_email_address')
-            smtp_obj = setup_smtp(email_pw, email_address)
-            recipients = tuple(cfg[key] for key, value in cfg.items() if 'recipient' in key)
-            if success:
-                message_to_send = success_message()
-                #logfile = None
-            else:
-                message_to_send = failure_message()
-                #logfile = get_log()
-            for recipient in recipients:
-                prepared_message = prep_message(message_to_send, email_address, recipient, logfile)
-                smtp_obj.sendmail(email_address, recipient, prepared_message.as_string())
-    except Exception as e:
-        #log.error(e)
-        print(e)
+        cfg = load_cfg()
+        email_pw = cfg.status_email_password
+        email_address = cfg.status_email_address
+        recipients = cfg.recipients
+        if success:
+            message_to_send = success_message()
+            #logfile = None
+        else:
+            message_to_send = failure_message()
+            #logfile = get_log()
+        # the message is the same for everyone, so it goes out once with all of the recipients on the envelope
+        prepared_message = prep_message(message_to_send, email_address, ', '.join(recipients), logfile)
+        # serialized once, straight to bytes with CRLF line endings, so smtplib sends it as-is for every batch of
+        # recipients instead of re-encoding a str each time
+        message_bytes = prepared_message.as_bytes(policy=SMTP)
+        # logging in comes after the message is built, so a connection is only opened once there's something to send
+        smtp_obj = setup_smtp(email_pw, email_address)
+        smtp_obj = send_in_batches(smtp_obj, email_pw, email_address, recipients, message_bytes,
+                                   cfg.smtp_batch_size, cfg.smtp_messages_per_connection)
+        # the connection is closed once the message is sent, rather than left open for the server to time out.
+        # If sending fails, send_in_batches closes it
+        close_smtp(smtp_obj)
+    except Exception:
+        log.exception('Sending status email failed')
 
 def main():
     send_it(success=False)